@@ -1,12 +1,22 @@
+import codecs
 import os
 import re
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, Tuple, Union
+from typing import Iterable, List, Tuple, Union
+
+_mswindows = sys.platform == "win32"
+
+_READ_CHUNK_SIZE = 65536
 
 
 @contextmanager
-def cwd(path):
+def cwd(path: Union[str, os.PathLike]):
     wd = os.getcwd()
     os.chdir(path)
     try:
@@ -15,6 +25,28 @@ def cwd(path):
         os.chdir(wd)
 
 
+def _read_all(stream) -> str:
+    """以64KB为单位读取管道直到EOF，边读取边按utf-8解码"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    fd = stream.fileno()
+    chunks = []
+    while True:
+        data = os.read(fd, _READ_CHUNK_SIZE)
+        if not data:
+            break
+        chunks.append(decoder.decode(data))
+    chunks.append(decoder.decode(b"", final=True))
+    return "".join(chunks)
+
+
+def _decode_output(data: bytes) -> str:
+    output = data.decode("utf-8", errors="replace")
+    # windows下的命令行程序可能输出gbk编码
+    if _mswindows and "\ufffd" in output:
+        output = data.decode("gbk", errors="replace")
+    return output
+
+
 def runcmd(
     args: Union[str, Iterable[Union[str, Path]]],
     shell=False,
@@ -23,6 +55,7 @@ def runcmd(
     input=None,
     timeout=None,
     check=False,
+    discard_output=False,
     **kwargs,
 ) -> Tuple[str, int]:
     """对subprocess.Popen的封装
@@ -35,25 +68,24 @@ def runcmd(
         input (str, optional): 用户输入. Defaults to None.
         timeout (float, optional): 超时时间. Defaults to None.
         check (bool, optional): 是否检查异常，为True时将抛出异常. Defaults to False.
+        discard_output (bool, optional): 是否丢弃标准输出和错误输出，为True时忽略enable_stdout. Defaults to False.
     Returns:
         Tuple[str, int]: 返回：(output, returncode)
     """
-    import shlex
-    import subprocess
-
-    try:
-        import msvcrt
-    except ModuleNotFoundError:
-        _mswindows = False
-    else:
-        _mswindows = True
-
     if input is not None:
         if kwargs.get("stdin") is not None:
             raise ValueError("stdin and input arguments may not both be used.")
         kwargs["stdin"] = subprocess.PIPE
 
-    if not enable_stdout:
+    if discard_output:
+        if kwargs.get("stdout") is not None or kwargs.get("stderr") is not None:
+            raise ValueError(
+                "stdout and stderr arguments may not be used "
+                "when discard_output is True."
+            )
+        kwargs["stdout"] = subprocess.DEVNULL
+        kwargs["stderr"] = subprocess.DEVNULL
+    elif not enable_stdout:
         if kwargs.get("stdout") is not None or kwargs.get("stderr") is not None:
             raise ValueError(
                 "stdout and stderr arguments may not be used "
@@ -89,7 +121,20 @@ def runcmd(
     try:
         with subprocess.Popen(args, **kwargs) as process:
             try:
-                stdout, stderr = process.communicate(input, timeout=timeout)
+                if (
+                    not _mswindows
+                    and input is None
+                    and timeout is None
+                    and process.stdin is None
+                    and process.stdout is not None
+                    and process.stderr is None
+                ):
+                    # 只有一个输出管道时直接读取，无需 communicate 的多路读取
+                    # windows需要保留原始字节以便回退到gbk解码，仍走 communicate
+                    stdout, stderr = _read_all(process.stdout), None
+                    process.wait()
+                else:
+                    stdout, stderr = process.communicate(input, timeout=timeout)
             except subprocess.TimeoutExpired as e:
                 process.kill()
                 if _mswindows:
@@ -107,113 +152,203 @@ def runcmd(
         output = "" if enable_stdout else str(exc)
         return output, retcode
     retcode = int(process.poll())
+    if isinstance(stdout, bytes):
+        stdout = _decode_output(stdout)
+    if isinstance(stderr, bytes):
+        stderr = _decode_output(stderr)
     if check and retcode:
         raise subprocess.CalledProcessError(
             retcode, process.args, output=stdout, stderr=stderr
         )
-    if stdout:
-        if stdout[-2:] == b"\r\n":
-            stdout = stdout[:-2]
-        elif stdout[-1:] == b"\n":
-            stdout = stdout[:-1]
-        for enc in ["utf-8", "gbk"]:
-            try:
-                output = stdout.decode(enc)
-                return output, retcode
-            except Exception:
-                pass
-        output = stdout.decode("utf-8", errors="ignore")
-    else:
-        output = ""
+    output = stdout or ""
+    if output[-2:] == "\r\n":
+        output = output[:-2]
+    elif output[-1:] == "\n":
+        output = output[:-1]
     return output, retcode
 
 
-def shell_exec(cmd: str):
-    print(f"🛩️ 运行命令: {cmd}")
+def _format_cmd(cmd: Union[str, List[str]]) -> str:
+    return cmd if isinstance(cmd, str) else shlex.join(cmd)
+
+
+def _print_banner(cmd: Union[str, List[str]], flush=False):
+    print(f"🛩️ 运行命令: {_format_cmd(cmd)}", flush=flush)
+
+
+def shell_exec(cmd: Union[str, List[str]], discard_output=False):
+    # 子进程直接写入继承的stdout，先刷新缓冲区以保证日志顺序；
+    # 丢弃输出的命令不会写stdout，提示信息留在缓冲区与后续输出一起写出
+    _print_banner(cmd, flush=not discard_output)
     try:
-        runcmd(cmd, enable_stdout=True, check=True)
+        runcmd(cmd, enable_stdout=True, check=True, discard_output=discard_output)
     except Exception:
-        print("❌出错了：")
+        print("❌出错了：", flush=True)
         raise
 
 
-def runcmd_check_error(cmd: str):
+def runcmd_check_error(cmd: Union[str, List[str]], **kwargs):
     try:
-        return runcmd(cmd, check=True)
-    except Exception:
+        return runcmd(cmd, check=True, **kwargs)
+    except Exception as exc:
         print("❌出错了：")
+        # 输出已被捕获，失败时打印出来以便排查
+        output = getattr(exc, "output", None)
+        if output:
+            print(output)
+        sys.stdout.flush()
         raise
 
 
+def runcmd_batch(cmds: List[str], delimiter="\n---\n", **kwargs) -> List[str]:
+    """在同一个bash进程中依次执行多条命令，遇到错误立即停止
+
+    Args:
+        cmds (List[str]): shell命令列表
+        delimiter (str, optional): 用于分隔各命令输出的字符串，不能出现在命令输出中. Defaults to "\n---\n".
+    Returns:
+        List[str]: 每条命令各自的输出
+    """
+    separator = f"; printf %s {shlex.quote(delimiter)}; "
+    # 末尾追加哨兵，最后一条命令的输出也以分隔符结束，不受runcmd去除末尾换行的影响
+    script = "set -e; " + separator.join([*cmds, "printf ."])
+    out, _ = runcmd_check_error(["bash", "-c", script], **kwargs)
+    outputs = out.split(delimiter)[:-1]
+    if len(outputs) != len(cmds):
+        raise ValueError(
+            f"command output must not contain the delimiter {delimiter!r}"
+        )
+    return [item.rstrip("\r\n") for item in outputs]
+
+
+def run_parallel(groups: List[List[Union[str, List[str]]]]):
+    """按组执行命令：组与组之间顺序执行，组内命令并发执行
+
+    Args:
+        groups (List[List[Union[str, List[str]]]]): 命令分组，后一组依赖前一组的结果，
+            命令可以是str或已拆分好的参数列表
+    """
+    for group in groups:
+        # 先输出本组的命令，命令卡住时日志中也能看到正在执行什么
+        for cmd in group:
+            _print_banner(cmd)
+        sys.stdout.flush()
+        # 已启动的命令无法中途取消，退出with时会等待本组全部结束
+        with ThreadPoolExecutor(max_workers=len(group)) as executor:
+            futures = [executor.submit(runcmd, cmd, check=True) for cmd in group]
+        # 按提交顺序输出，保证日志顺序稳定
+        for cmd, future in zip(group, futures):
+            try:
+                out, _ = future.result()
+            except Exception as exc:
+                print(f"❌出错了：{_format_cmd(cmd)}")
+                output = getattr(exc, "output", None)
+                if output:
+                    print(output)
+                sys.stdout.flush()
+                raise
+            if out:
+                if len(group) > 1:
+                    print(f"📋 {_format_cmd(cmd)} 输出:")
+                print(out)
+
+
 def get_caddy_version():
     cmd = "./caddy version"
     out, _ = runcmd_check_error(cmd)
     # out = "v2.8.4 h1:q3pe0wpBj1OcHFZ3n/1nl4V4bxBrYoSoab7rL9BMYNk="
     version = full_version = out.strip()
-    result = re.search(r"\S+", version)
-    if result:
-        version = result.group(0)
+    parts = version.split(None, 1)
+    if parts:
+        version = parts[0]
     return full_version, version
 
 
-def get_tags():
-    cmd = "git tag --list"
-    out, _ = runcmd_check_error(cmd)
-    return [item.strip() for item in out.split("\n")]
+@lru_cache(maxsize=1)
+def get_tags(repo_dir=None):
+    cmd = ["git", "for-each-ref", "--format=%(refname:strip=2)", "refs/tags/"]
+    out, _ = runcmd_check_error(cmd, cwd=repo_dir)
+    return frozenset(out.splitlines())
 
 
-def generate_new_tag(caddy_version):
-    tags = get_tags()
-    new_tag = caddy_version
-    build_num = 1
-    while new_tag in tags:
-        new_tag = f"{caddy_version}-{build_num}"
-        build_num += 1
-    return new_tag
+def generate_new_tag(caddy_version, tags):
+    # 版本号本身记为构建号0，已有构建号的最大值加1即为新构建号
+    tag_re = re.compile(rf"{re.escape(caddy_version)}(?:-(\d+))?")
+    max_build_num = -1
+    for tag in tags:
+        result = tag_re.fullmatch(tag)
+        if result:
+            max_build_num = max(max_build_num, int(result.group(1) or 0))
+    if max_build_num < 0:
+        return caddy_version
+    return f"{caddy_version}-{max_build_num + 1}"
 
 
-def set_runner_env_var(name, value):
-    os.popen(f'echo "{name}={value}" >> $GITHUB_ENV')
+def set_runner_env_vars(pairs: dict):
+    env_file = os.getenv("GITHUB_ENV")
+    if not env_file:
+        return
+    with open(env_file, "a", encoding="utf-8", buffering=8192) as f:
+        f.writelines(f"{name}={value}\n" for name, value in pairs.items())
 
 
 def build():
-    repo_parent = os.getenv("REPO_PARENT", "")
+    repo_parent = os.getenv("REPO_PARENT") or "."
     github_repo = os.getenv("GITHUB_REPOSITORY", "")
+    # git不做可选的index刷新写入，凭据有问题时直接失败而不是等待输入
+    os.environ.setdefault("GIT_OPTIONAL_LOCKS", "0")
+    os.environ.setdefault("GIT_TERMINAL_PROMPT", "0")
 
-    shell_exec("go install github.com/caddyserver/xcaddy/cmd/xcaddy@latest")
-    shell_exec(
-        "xcaddy build --with github.com/caddyserver/forwardproxy=github.com/klzgrad/forwardproxy@naive"
-    )
-    shell_exec("chmod +x ./caddy")
-    full_version, short_version = get_caddy_version()
-    print(f"full version: {full_version} version: {short_version}")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # 获取tag列表与构建互不依赖，放到后台和构建同时进行
+        tags_future = executor.submit(get_tags, repo_parent)
 
-    with cwd(Path(repo_parent)):
-        new_tag = generate_new_tag(short_version)
+        # 已安装xcaddy时跳过安装，设置 FORCE_XCADDY_UPDATE 可强制更新
+        _, retcode = runcmd("xcaddy version")
+        if retcode != 0 or os.getenv("FORCE_XCADDY_UPDATE"):
+            shell_exec("go install github.com/caddyserver/xcaddy/cmd/xcaddy@latest")
+        shell_exec(
+            "xcaddy build --with github.com/caddyserver/forwardproxy=github.com/klzgrad/forwardproxy@naive"
+        )
+        shell_exec("chmod +x ./caddy", discard_output=True)
+        full_version, short_version = get_caddy_version()
+        print(f"full version: {full_version} version: {short_version}")
+        tags = tags_future.result()
+
+    with cwd(repo_parent):
+        new_tag = generate_new_tag(short_version, tags)
         download_url = (
             f"https://github.com/{github_repo}/releases/download/{new_tag}/caddy"
         )
-        Path("README.md").write_text(
-            f"# naiveproxy-server-build\n### caddy最新构建版本：[{new_tag}]({download_url})"
-        )
+        readme = f"# naiveproxy-server-build\n### caddy最新构建版本：[{new_tag}]({download_url})"
+        fd = os.open("README.md", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, readme.encode("utf-8"))
+        finally:
+            os.close(fd)
         ref_name = os.getenv("GITHUB_REF_NAME", "")
 
-        cmd_list = [
+        git_config_cmds = [
             "git config --global user.email nomeqc@gmail.com",
             "git config --global user.name Fallrainy",
-            "git add README.md",
-            'git commit -m "Update README.md"',
-            f'git pull --rebase origin "{ref_name}"',
-            f'git push origin "{ref_name}"',
-            f'git tag "{new_tag}"',
-            f'git push origin "{new_tag}"',
         ]
-        for cmd in cmd_list:
-            shell_exec(cmd)
+        for cmd in git_config_cmds:
+            _print_banner(cmd)
+        runcmd_batch(git_config_cmds)
+        shell_exec(["git", "add", "README.md"], discard_output=True)
+
+        cmd_groups = [
+            [["git", "commit", "-m", "Update README.md"]],
+            [["git", "pull", "--rebase", "origin", ref_name]],
+            [["git", "push", "origin", ref_name], ["git", "tag", new_tag]],
+            [["git", "push", "origin", new_tag]],
+        ]
+        run_parallel(cmd_groups)
+        # 已创建新tag，缓存的tag列表失效
+        get_tags.cache_clear()
 
         # 将新tag写入到环境变量文件 以备下一步使用
-        set_runner_env_var("NEW_TAG", new_tag)
-        set_runner_env_var("FULL_VERSION", full_version)
+        set_runner_env_vars({"NEW_TAG": new_tag, "FULL_VERSION": full_version})
 
 
 if __name__ == "__main__":